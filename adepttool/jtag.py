@@ -8,32 +8,146 @@ def wordrev(word):
     return sum(1 << (31 - i) for i in range(32) if word & 1 << i)
 
 def byterev(data):
-    return bytes(byterev_xlat[x] for x in data)
+    return bytes(data).translate(byterev_xlat)
 
 class UnknownDeviceError(Exception):
     pass
 
+class ChainError(Exception):
+    pass
+
+
+# Limits for chain discovery; they determine the size of the single
+# discovery transfer.
+MAX_DEVICES = 32
+MAX_IR_LEN = 256
+
+
+class DeviceRegistry:
+    def __init__(self, devices=()):
+        # mask -> {masked idcode -> (cls, name)}
+        self.index = {}
+        for idc, idm, cls, nam in devices:
+            self.register(idc, idm, cls, nam)
+
+    def register(self, idcode, mask, cls, name):
+        self.index.setdefault(mask, {})[idcode & mask] = cls, name
+
+    def lookup(self, idcode):
+        for mask, devs in self.index.items():
+            res = devs.get(idcode & mask)
+            if res is not None:
+                return res
+        return None
+
 
 class Chain:
-    def __init__(self, port):
+    def __init__(self, port, registry=None):
         self.port = port
-
-    def init(self):
+        if registry is None:
+            registry = REGISTRY
+        self.registry = registry
+
+    def init(self, allow_unknown=False):
+        # Discovers the whole chain in one transfer: reset and read out the
+        # IDCODE/BYPASS registers, then flush the IR chain and (now in BYPASS)
+        # the DR chain to measure their lengths.
         self.port.enable()
-        self.port.put_tms_tdi_bits(False, 9, bytes([0xaa, 0x22, 0x00]))
-        self.devices = []
+        seq = []
+        def shift(tdi, num, last):
+            start = len(seq)
+            seq.extend((False, tdi) for _ in range(num))
+            if last:
+                seq[-1] = (True, tdi)
+            return start
+        def move(tms):
+            seq.extend((t, False) for t in tms)
+        # Test-Logic-Reset -> Shift-DR.
+        move([True] * 5 + [False, True, False, False])
+        id_len = MAX_DEVICES * 32 + 32
+        id_pos = shift(True, id_len, True)
+        # Exit1-DR -> Shift-IR.
+        move([True, True, True, False, False])
+        ir_pos = shift(False, MAX_IR_LEN, False)
+        shift(True, MAX_IR_LEN + 1, True)
+        # Exit1-IR -> Shift-DR.
+        move([True, True, False, False])
+        dr_pos = shift(False, MAX_DEVICES, False)
+        shift(True, MAX_DEVICES + 1, True)
+        # Exit1-DR -> Update-DR.
+        move([True])
+        data = bytes(
+            sum((tms << 1 | tdi) << (2 * j) for j, (tms, tdi) in enumerate(seq[i:i+4]))
+            for i in range(0, len(seq), 4)
+        )
+        tdo = int.from_bytes(self.port.put_tms_tdi_bits(True, len(seq), data), 'little')
+        def bits(pos, num):
+            return tdo >> pos & ((1 << num) - 1)
+
+        # A device in BYPASS shows a single 0 bit, an IDCODE always has
+        # bit 0 set.  The all-ones we shifted in mark the end of the chain.
+        idcodes = []
+        pos = 0
         while True:
-            res = self.port.get_tdo_bits(False, False, 32)
-            res = int.from_bytes(res, 'little')
-            if res == 0:
-                break
-            for idc, idm, cls, nam in DEVICES:
-                if (res & idm) == idc:
-                    self.devices.append(cls(self, res, nam))
+            if len(idcodes) > MAX_DEVICES:
+                raise ChainError('more than {} devices in chain'.format(MAX_DEVICES))
+            if pos + 32 > id_len:
+                raise ChainError('no end of IDCODE chain found')
+            if not bits(id_pos + pos, 1):
+                idcodes.append(None)
+                pos += 1
+            else:
+                res = bits(id_pos + pos, 32)
+                if res == 0xffffffff:
                     break
+                idcodes.append(res)
+                pos += 32
+
+        # After the zero flush, the first 1 to come out of the IR chain
+        # is the first of the ones we shifted in after it.
+        ir_out = bits(ir_pos + MAX_IR_LEN, MAX_IR_LEN + 1)
+        if not ir_out:
+            raise ChainError('IR chain longer than {}'.format(MAX_IR_LEN))
+        self.ir_len = (ir_out & -ir_out).bit_length() - 1
+        dr_out = bits(dr_pos + MAX_DEVICES, MAX_DEVICES + 1)
+        if not dr_out:
+            raise ChainError('more than {} devices in chain'.format(MAX_DEVICES))
+        self.dr_len = (dr_out & -dr_out).bit_length() - 1
+        if self.dr_len != len(idcodes):
+            raise ChainError('{} devices in BYPASS, but {} in IDCODE scan'.format(
+                self.dr_len, len(idcodes)))
+
+        found = [
+            self.registry.lookup(idcode) if idcode is not None else None
+            for idcode in idcodes
+        ]
+        unknown = [idcode for idcode, res in zip(idcodes, found) if res is None]
+        if unknown and not allow_unknown:
+            raise UnknownDeviceError('unknown IDCODE {}'.format(
+                ', '.join('{:08x}'.format(idc) if idc is not None else '(none)'
+                          for idc in unknown)))
+        known_ir_len = sum(cls.IR_LEN for cls, nam in filter(None, found))
+        unknown_ir_len = self.ir_len - known_ir_len
+        if not unknown:
+            if unknown_ir_len:
+                raise ChainError('IR chain is {} bits, expected {}'.format(
+                    self.ir_len, known_ir_len))
+        elif len(unknown) > 1 or unknown_ir_len < 2:
+            # We can only split the IR chain if exactly one device has an
+            # unknown IR length.
+            raise UnknownDeviceError('cannot determine IR layout ({} bits total, {} known)'.format(
+                self.ir_len, known_ir_len))
+
+        self.devices = []
+        for idcode, res in zip(idcodes, found):
+            if res is not None:
+                cls, nam = res
+                dev = cls(self, idcode, nam)
             else:
-                raise UnknownDeviceError('unknown IDCODE {res:08x}'.format(res=res))
-        self.port.put_tms_tdi_bits(False, 2, bytes([0xa]))
+                dev = UnknownJtagDev(self, idcode, unknown_ir_len)
+            # The IR flush left every device in BYPASS.
+            dev.loaded_cmd = dev.cur_cmd
+            self.devices.append(dev)
 
     def shift_num(self, num, length, last):
         if num >= (1 << length):
@@ -85,22 +199,79 @@ class Chain:
         for dev, ir in zip(self.devices, irs):
             res.append(self.shift_num(ir, dev.IR_LEN, dev is self.devices[-1]))
         self.port.put_tms_tdi_bits(False, 1, bytes([0x2]))
+        for dev, ir in zip(self.devices, irs):
+            dev.loaded_cmd = ir
         return res
 
-    def shift_dr_one_num(self, cdev, num, length):
+    def load_ir(self, force=False):
+        # Only scan IR when some device's wanted instruction differs from
+        # the one last loaded.  Returns True if a scan was performed.
+        if force or any(dev.loaded_cmd != dev.cur_cmd for dev in self.devices):
+            self.shift_ir()
+            return True
+        return False
+
+    def prep_cmds(self, cmds, force=False):
+        for dev, cmd in cmds:
+            dev.cur_cmd = cmd
+        return self.load_ir(force)
+
+    def prep_dr(self, targets):
+        # targets is a list of (dev, cmd), cmd None meaning keep the current
+        # one.  Every other device is put in BYPASS, so that it shows up as
+        # a single bit in the DR chain; this overwrites their cur_cmd, so an
+        # instruction loaded earlier with prep_cmd has to be loaded again
+        # before it is used.
+        cmds = [(dev, cmd) for dev, cmd in targets if cmd is not None]
+        tdevs = [dev for dev, cmd in targets]
+        for dev in self.devices:
+            if dev not in tdevs:
+                cmds.append((dev, (1 << dev.IR_LEN) - 1))
+        return self.prep_cmds(cmds)
+
+    def shift_dr_multi(self, targets):
+        # targets is a list of (dev, cmd, num, length).  If cmd is not None,
+        # it is loaded first; all other devices get BYPASS loaded in the
+        # same IR scan (skipped if nothing changed).  The whole DR chain is
+        # then shifted in one pass, and the list of values captured from
+        # each target is returned.
+        lens = {dev: 1 for dev in self.devices}
+        nums = {}
+        for dev, cmd, num, length in targets:
+            if dev not in lens:
+                raise ValueError('device {} not in chain'.format(dev.name))
+            if dev in nums:
+                raise ValueError('device {} targeted twice'.format(dev.name))
+            if not length or num >= (1 << length):
+                raise ValueError
+            lens[dev] = length
+            nums[dev] = num
+        self.prep_dr([(dev, cmd) for dev, cmd, num, length in targets])
+        offs = {}
+        total = 0
+        data = 0
+        for dev in self.devices:
+            offs[dev] = total
+            data |= nums.get(dev, 0) << total
+            total += lens[dev]
         self.port.put_tms_tdi_bits(False, 3, bytes([0x2]))
-        idx = self.devices.index(cdev)
-        if idx:
-            self.shift_num(0, idx, False)
-        if idx != len(self.devices) - 1:
-            res = self.shift_num(num, length, False)
-            self.shift_num(0, len(self.devices) - 1 - idx, True)
-        else:
-            res = self.shift_num(num, length, True)
+        res = self.shift_num(data, total, True)
         self.port.put_tms_tdi_bits(False, 1, bytes([0x2]))
-        return res
+        return [
+            res >> offs[dev] & ((1 << length) - 1)
+            for dev, cmd, num, length in targets
+        ]
+
+    def shift_dr_one_num(self, cdev, num, length):
+        return self.shift_dr_multi([(cdev, None, num, length)])[0]
 
     def shift_dr_one_bytes(self, cdev, data, length):
+        # Single-target only: data can be a whole bitstream, so it is
+        # shifted as bytes instead of being packed with the other devices'
+        # bypass bits like shift_dr_multi does.
+        if (length + 7) // 8 != len(data) or not length:
+            raise ValueError
+        self.prep_dr([(cdev, None)])
         self.port.put_tms_tdi_bits(False, 3, bytes([0x2]))
         idx = self.devices.index(cdev)
         if idx:
@@ -126,11 +297,15 @@ class JtagDev:
         self.idcode = idcode
         self.name = name
         self.cur_cmd = (1 << self.IR_LEN) - 1
+        # What we know to be in the IR right now, None if unknown.
+        self.loaded_cmd = None
 
-    def prep_cmd(self, cmd):
+    def prep_cmd(self, cmd, force=False):
         self.cur_cmd = cmd
-        self.chain.shift_ir()
+        self.chain.load_ir(force)
 
+    # The DR scans put every other device in the chain in BYPASS
+    # (see Chain.prep_dr).
     def shift_dr_num(self, num, length):
         return self.chain.shift_dr_one_num(self, num, length)
 
@@ -144,16 +319,29 @@ class JtagDev:
                 return res[i]
 
 
+class UnknownJtagDev(JtagDev):
+    # A device not in the registry, with the IR length found by measuring
+    # the chain.
+    def __init__(self, chain, idcode, ir_len):
+        self.IR_LEN = ir_len
+        super().__init__(chain, idcode, None)
+
+
 class Spartan3(JtagDev):
     IR_LEN = 6
 
     def jprogram(self):
-        self.prep_cmd(0x0b)
+        # JPROGRAM acts on Update-IR, so it must always be scanned.
+        self.prep_cmd(0x0b, force=True)
 
     def cfg_in(self, data):
+        self.cfg_in_rev(byterev(data))
+
+    def cfg_in_rev(self, data):
+        # Like cfg_in, but data has already been passed through byterev.
         self.prep_cmd(0x05)
         if data:
-            self.shift_dr_bytes(byterev(data), len(data) * 8)
+            self.shift_dr_bytes(data, len(data) * 8)
 
     def jstart(self, num_rti=12):
         self.prep_cmd(0x0c)
@@ -173,14 +361,12 @@ class Spartan3(JtagDev):
         return self.shift_dr_num(0, 5)
 
     def isc_program(self, word):
-        if self.cur_cmd != 0x11:
-            self.prep_cmd(0x11)
+        self.prep_cmd(0x11)
         res = self.shift_dr_num(wordrev(word), 32)
         self.chain.clock_rti(1)
 
     def isc_read(self):
-        if self.cur_cmd != 0x15:
-            self.prep_cmd(0x15)
+        self.prep_cmd(0x15)
         self.chain.clock_rti(1)
         n = self.shift_dr_num(0, 69)
         stat = n & 0x1f
@@ -213,3 +399,5 @@ DEVICES = [
     (0x05045093, 0x0fffffff, PlatformFlashSerial, 'xcf02s'),
     (0x05046093, 0x0fffffff, PlatformFlashSerial, 'xcf04s'),
 ]
+
+REGISTRY = DeviceRegistry(DEVICES)
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import time
 import usb1
-from adepttool.device import get_devices
-from adepttool.jtag import Chain, Spartan3
+from adepttool.device import get_devices, DMGT_CAPS_CONFIG_RESET, DMGT_CAPS_QUERY_DONE
+from adepttool.jtag import Chain, Spartan3, byterev
 import sys
 
 parser = argparse.ArgumentParser(description='Program the FPGA on Basys 2.')
 parser.add_argument('--device', type=int, help='Device index', default=0)
+parser.add_argument('--no-dmgt', action='store_true',
+                    help='Use only JTAG, even if the board supports DMGT config reset / done query')
+parser.add_argument('--timing', action='store_true', help='Print time taken by each phase')
 parser.add_argument('bitfile', help='The bitstream file')
 
 args = parser.parse_args()
@@ -15,6 +19,15 @@ args = parser.parse_args()
 with open(args.bitfile, 'rb') as f:
     data = f.read()
 
+timings = []
+phase_start = time.monotonic()
+
+def phase(name):
+    global phase_start
+    now = time.monotonic()
+    timings.append((name, now - phase_start))
+    phase_start = now
+
 with usb1.USBContext() as ctx:
     devs = get_devices(ctx)
     if args.device >= len(devs):
@@ -31,6 +44,8 @@ with usb1.USBContext() as ctx:
     fpga = chain.devices[1]
     if not isinstance(fpga, Spartan3):
         print('Not a Spartan 3 device.')
+    dmgt_caps = 0 if args.no_dmgt else dev.dmgt.caps
+    phase('open')
 
     def print_status():
         status = fpga.get_status()
@@ -48,21 +63,52 @@ with usb1.USBContext() as ctx:
             flags = '-'
         print('STATUS: {}'.format(flags))
 
+    # The plain JTAG sequence prints the status after every step; the DMGT
+    # path skips that, since each readout costs an IR scan.
+    fast = dmgt_caps & (DMGT_CAPS_CONFIG_RESET | DMGT_CAPS_QUERY_DONE)
+    def step_status():
+        if not fast:
+            print_status()
 
-    print('JPROGRAM')
-    fpga.jprogram()
-    print_status()
-    fpga.cfg_in(b'')
+    if dmgt_caps & DMGT_CAPS_CONFIG_RESET:
+        # Hold PROG asserted while the bitstream is being prepared.
+        print('CONFIG RESET')
+        dev.dmgt.config_reset(1)
+        data = byterev(data)
+        dev.dmgt.config_reset(0)
+        phase('reset + prepare')
+    else:
+        print('JPROGRAM')
+        fpga.jprogram()
+        step_status()
+        fpga.cfg_in(b'')
+        phase('reset')
+        data = byterev(data)
+        phase('prepare')
     print('Wait for INIT')
     fpga.wait_for_init()
-    print_status()
+    step_status()
+    phase('wait for INIT')
     print('CFG_IN')
-    fpga.cfg_in(data)
-    print_status()
+    fpga.cfg_in_rev(data)
+    step_status()
+    phase('CFG_IN')
     print('JSTART')
     fpga.jstart()
-    print_status()
+    step_status()
+    phase('JSTART')
     print('Wait for DONE')
-    fpga.wait_for_done()
+    if dmgt_caps & DMGT_CAPS_QUERY_DONE:
+        while not dev.dmgt.query_done():
+            chain.clock_rti(12)
+        chain.clock_rti(12)
+    else:
+        fpga.wait_for_done()
+    phase('wait for DONE')
     print_status()
     chain.close()
+
+if args.timing:
+    for name, t in timings:
+        print('{:>16}: {:8.1f} ms'.format(name, t * 1000))
+    print('{:>16}: {:8.1f} ms'.format('total', sum(t for name, t in timings) * 1000))
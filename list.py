@@ -21,9 +21,11 @@ with usb1.USBContext() as ctx:
             print('\tDJTG PORT {port.idx}: {port.caps:08x} speed {speed}'.format(port=port, speed=port.get_speed()))
             port.disable()
             chain = Chain(port)
-            chain.init()
+            chain.init(allow_unknown=True)
             for jdev in chain.devices:
-                print('\t\tJTAG IDCODE {jdev.idcode:08x} [{jdev.name}]'.format(jdev=jdev))
+                idcode = '{:08x}'.format(jdev.idcode) if jdev.idcode is not None else '--------'
+                name = jdev.name or 'unknown, IR {}'.format(jdev.IR_LEN)
+                print('\t\tJTAG IDCODE {} [{}]'.format(idcode, name))
             chain.close()
         for port in dev.depp_ports:
             port.enable()
@@ -0,0 +1,260 @@
+import unittest
+
+from adepttool.jtag import (
+    Chain, ChainError, UnknownDeviceError, UnknownJtagDev,
+    PlatformFlashSerial, Spartan3, MAX_DEVICES, MAX_IR_LEN,
+)
+
+
+# TAP state -> (next state with TMS=0, next state with TMS=1)
+TAP_NEXT = {
+    'TLR': ('RTI', 'TLR'), 'RTI': ('RTI', 'SDS'),
+    'SDS': ('CDR', 'SIS'), 'CDR': ('SDR', 'E1D'), 'SDR': ('SDR', 'E1D'),
+    'E1D': ('PDR', 'UDR'), 'PDR': ('PDR', 'E2D'), 'E2D': ('SDR', 'UDR'),
+    'UDR': ('RTI', 'SDS'),
+    'SIS': ('CIR', 'TLR'), 'CIR': ('SIR', 'E1I'), 'SIR': ('SIR', 'E1I'),
+    'E1I': ('PIR', 'UIR'), 'PIR': ('PIR', 'E2I'), 'E2I': ('SIR', 'UIR'),
+    'UIR': ('RTI', 'SDS'),
+}
+
+
+class MockTap:
+    # A TAP with an optional IDCODE register, selected by reset.  drs maps
+    # instructions to data register lengths; any other instruction selects
+    # a 1-bit BYPASS register.
+    def __init__(self, ir_len, idcode=None, drs={}):
+        self.ir_len = ir_len
+        self.idcode = idcode
+        self.drs = drs
+        self.regs = {cmd: 0 for cmd in drs}
+        self.ir_loads = []
+        self.sr = []
+        self.reset()
+
+    def reset(self):
+        self.ir = None
+
+    def capture_dr(self):
+        if self.ir is None and self.idcode is not None:
+            self.sr = [self.idcode >> i & 1 for i in range(32)]
+        elif self.ir in self.drs:
+            self.sr = [self.regs[self.ir] >> i & 1 for i in range(self.drs[self.ir])]
+        else:
+            self.sr = [0]
+
+    def update_dr(self):
+        if self.ir in self.drs:
+            self.regs[self.ir] = sum(b << i for i, b in enumerate(self.sr))
+
+    def capture_ir(self):
+        self.sr = [1, 0] + [0] * (self.ir_len - 2)
+
+    def update_ir(self):
+        self.ir = sum(b << i for i, b in enumerate(self.sr))
+        self.ir_loads.append(self.ir)
+
+
+class MockPort:
+    # Implements the Djtg methods used by Chain.  taps[0] is nearest TDO.
+    def __init__(self, taps):
+        self.taps = taps
+        self.state = 'TLR'
+        self.cmds = 0
+
+    def enable(self):
+        pass
+
+    def disable(self):
+        pass
+
+    def clock(self, tms, tdi):
+        tdo = 0
+        if self.state in ('SDR', 'SIR'):
+            bit = tdi
+            for tap in reversed(self.taps):
+                bit, tap.sr = tap.sr[0], tap.sr[1:] + [bit]
+            tdo = bit
+        self.state = TAP_NEXT[self.state][tms]
+        for tap in self.taps:
+            if self.state == 'TLR':
+                tap.reset()
+            elif self.state == 'CDR':
+                tap.capture_dr()
+            elif self.state == 'UDR':
+                tap.update_dr()
+            elif self.state == 'CIR':
+                tap.capture_ir()
+            elif self.state == 'UIR':
+                tap.update_ir()
+        return tdo
+
+    def pack(self, bits):
+        return bytes(
+            sum(b << j for j, b in enumerate(bits[i:i+8]))
+            for i in range(0, len(bits), 8)
+        )
+
+    def put_tms_tdi_bits(self, oe, bits, data):
+        self.cmds += 1
+        res = [
+            self.clock(data[i // 4] >> (i % 4 * 2 + 1) & 1, data[i // 4] >> (i % 4 * 2) & 1)
+            for i in range(bits)
+        ]
+        return self.pack(res) if oe else None
+
+    def put_tdi_bits(self, oe, tms, bits, data):
+        self.cmds += 1
+        res = [self.clock(int(tms), data[i // 8] >> (i % 8) & 1) for i in range(bits)]
+        return self.pack(res) if oe else None
+
+    def get_tdo_bits(self, tms, tdi, bits):
+        self.cmds += 1
+        return self.pack([self.clock(int(tms), int(tdi)) for i in range(bits)])
+
+    def clock_tck(self, tms, tdi, bits):
+        self.cmds += 1
+        for i in range(bits):
+            self.clock(int(tms), int(tdi))
+
+
+def make_chain(taps, **kwargs):
+    port = MockPort(taps)
+    chain = Chain(port)
+    chain.init(**kwargs)
+    return port, chain
+
+
+class ChainInitTest(unittest.TestCase):
+    def test_known_chain(self):
+        port, chain = make_chain([MockTap(8, 0x15045093), MockTap(6, 0x21c10093)])
+        self.assertEqual(port.cmds, 1)
+        self.assertEqual(port.state, 'UDR')
+        self.assertEqual(chain.ir_len, 14)
+        self.assertEqual(chain.dr_len, 2)
+        flash, fpga = chain.devices
+        self.assertIsInstance(flash, PlatformFlashSerial)
+        self.assertEqual((flash.idcode, flash.name), (0x15045093, 'xcf02s'))
+        self.assertIsInstance(fpga, Spartan3)
+        self.assertEqual((fpga.idcode, fpga.name), (0x21c10093, 'xc3s100e'))
+        # Discovery leaves everything in BYPASS, so no IR scan is needed.
+        self.assertFalse(chain.load_ir())
+        for tap in port.taps:
+            self.assertEqual(tap.ir, (1 << tap.ir_len) - 1)
+
+    def test_empty_chain(self):
+        port, chain = make_chain([])
+        self.assertEqual(chain.devices, [])
+
+    def test_bypass_only_device(self):
+        taps = [MockTap(8, 0x05045093), MockTap(4), MockTap(6, 0x01c10093)]
+        with self.assertRaises(UnknownDeviceError):
+            make_chain(taps)
+        port, chain = make_chain(taps, allow_unknown=True)
+        flash, unk, fpga = chain.devices
+        self.assertIsInstance(unk, UnknownJtagDev)
+        self.assertEqual((unk.idcode, unk.name, unk.IR_LEN), (None, None, 4))
+        self.assertEqual(fpga.IR_LEN, 6)
+
+    def test_unknown_device(self):
+        port, chain = make_chain([MockTap(10, 0x12345679), MockTap(6, 0x01c10093)], allow_unknown=True)
+        unk, fpga = chain.devices
+        self.assertIsInstance(unk, UnknownJtagDev)
+        self.assertEqual((unk.idcode, unk.IR_LEN), (0x12345679, 10))
+
+    def test_two_unknown_devices(self):
+        taps = [MockTap(5, 0x12345679), MockTap(5), MockTap(6, 0x01c10093)]
+        with self.assertRaises(UnknownDeviceError):
+            make_chain(taps, allow_unknown=True)
+
+    def test_ir_len_mismatch(self):
+        with self.assertRaises(ChainError):
+            make_chain([MockTap(7, 0x05045093)])
+
+    def test_limits(self):
+        port, chain = make_chain([MockTap(8, 0x05045093) for i in range(MAX_DEVICES)])
+        self.assertEqual(len(chain.devices), MAX_DEVICES)
+        with self.assertRaises(ChainError):
+            make_chain([MockTap(8, 0x05045093) for i in range(MAX_DEVICES + 1)])
+        port, chain = make_chain([MockTap(MAX_IR_LEN - 6, 0x12345679), MockTap(6, 0x01c10093)], allow_unknown=True)
+        self.assertEqual(chain.ir_len, MAX_IR_LEN)
+        with self.assertRaises(ChainError):
+            make_chain([MockTap(MAX_IR_LEN - 5, 0x12345679), MockTap(6, 0x01c10093)], allow_unknown=True)
+
+
+class ChainScanTest(unittest.TestCase):
+    def setUp(self):
+        self.flash_tap = MockTap(8, 0x05045093, {0x42: 16})
+        self.fpga_tap = MockTap(6, 0x01c10093, {0x05: 5, 0x14: 5})
+        self.port, self.chain = make_chain([self.flash_tap, self.fpga_tap])
+        self.flash, self.fpga = self.chain.devices
+        # Forget the BYPASS load done by discovery.
+        self.flash_tap.ir_loads = []
+        self.fpga_tap.ir_loads = []
+        self.flash_tap.regs[0x42] = 0x1234
+        self.fpga_tap.regs[0x14] = 0x15
+
+    def test_two_targets(self):
+        res = self.chain.shift_dr_multi([
+            (self.fpga, 0x14, 0x0a, 5),
+            (self.flash, 0x42, 0xabcd, 16),
+        ])
+        self.assertEqual(res, [0x15, 0x1234])
+        self.assertEqual(self.flash_tap.regs[0x42], 0xabcd)
+        self.assertEqual(self.fpga_tap.regs[0x14], 0x0a)
+        self.assertEqual(self.flash_tap.ir_loads, [0x42])
+        self.assertEqual(self.fpga_tap.ir_loads, [0x14])
+        # Same instructions again: no IR scan.
+        res = self.chain.shift_dr_multi([
+            (self.fpga, 0x14, 0, 5),
+            (self.flash, 0x42, 0, 16),
+        ])
+        self.assertEqual(res, [0x0a, 0xabcd])
+        self.assertEqual(self.flash_tap.ir_loads, [0x42])
+
+    def test_non_target_bypass(self):
+        self.fpga.prep_cmd(0x05)
+        self.assertEqual(self.fpga_tap.ir, 0x05)
+        res = self.chain.shift_dr_multi([(self.flash, 0x42, 0xabcd, 16)])
+        self.assertEqual(res, [0x1234])
+        self.assertEqual(self.fpga_tap.ir, 0x3f)
+        self.assertEqual(self.fpga.cur_cmd, 0x3f)
+        self.assertEqual(self.fpga_tap.regs[0x05], 0)
+        self.assertEqual(self.flash_tap.regs[0x42], 0xabcd)
+        self.fpga.prep_cmd(0x05)
+        self.assertEqual(self.flash.shift_dr_bytes(b'\x11\x22', 16), b'\xcd\xab')
+        self.assertEqual(self.fpga_tap.ir, 0x3f)
+        self.assertEqual(self.flash_tap.regs[0x42], 0x2211)
+
+    def test_one_num(self):
+        self.assertEqual(self.fpga.isc_noop(), 0x15)
+        self.assertEqual(self.fpga_tap.regs[0x14], 0)
+        self.assertEqual(self.flash_tap.ir, 0xff)
+
+    def test_skip_ir(self):
+        self.fpga.prep_cmd(0x05)
+        cmds = self.port.cmds
+        self.fpga.prep_cmd(0x05)
+        self.assertEqual(self.port.cmds, cmds)
+        self.assertEqual(self.fpga_tap.ir_loads, [0x05])
+
+    def test_jprogram_rescans(self):
+        self.fpga.jprogram()
+        self.fpga.jprogram()
+        self.assertEqual(self.fpga_tap.ir_loads, [0x0b, 0x0b])
+
+    def test_bad_targets(self):
+        other = make_chain([MockTap(8, 0x05045093)])[1].devices[0]
+        for targets in [
+            [(other, 0x42, 0, 16)],
+            [(self.fpga, 0x14, 0, 5), (self.fpga, 0x14, 0, 5)],
+            [(self.fpga, 0x14, 32, 5)],
+        ]:
+            with self.assertRaises(ValueError):
+                self.chain.shift_dr_multi(targets)
+        self.assertEqual(self.port.cmds, 1)
+        self.assertEqual(self.fpga_tap.ir_loads, [])
+        self.assertEqual(self.fpga.cur_cmd, 0x3f)
+
+
+if __name__ == '__main__':
+    unittest.main()